@@ -1,8 +1,54 @@
-from utils import save_maps
+from utils import save_maps, load_map, config
 from rpc import send_command
+import os
+import time
 
-def map_assets():
-    assets = send_command('listassets', ["", True])
+# Reissues older than this are dropped, API workers poll reissues.json every few seconds
+# so they have long since invalidated the name, and a worker started later never cached it
+reissue_horizon = config.getint('Resolver', 'reissue_horizon', fallback=3600)
+
+# The by_name map of the previous sync and the recorded reissues, kept in memory by the daemon
+previous_by_name = None
+reissues = None
+
+def detect_reissues(previous_by_name, by_name):
+    """
+    Find the assets whose ipfs_hash changed since the previous sync (e.g. a reissue
+    with a new IPFS hash) and record them in ./data/maps/reissues.json so the API
+    can invalidate its name resolution cache for exactly those names.
+    """
+    global reissues
+    if reissues is None:
+        reissues = load_map("reissues") if os.path.exists('./data/maps/reissues.json') else {}
+    detected = time.time()
+
+    # Forget reissues past the horizon
+    expired = [asset_name for asset_name, reissue in reissues.items() if reissue.get('detected', 0) < detected - reissue_horizon]
+    for asset_name in expired:
+        del reissues[asset_name]
+
+    changed = 0
+    for asset_name, asset_data in by_name.items():
+        previous = previous_by_name.get(asset_name)
+        if previous is None or previous.get('ipfs_hash') == asset_data.get('ipfs_hash'):
+            continue
+        reissues[asset_name] = {
+            'old_ipfs_hash': previous.get('ipfs_hash'),
+            'new_ipfs_hash': asset_data.get('ipfs_hash'),
+            'detected': detected,
+        }
+        changed += 1
+
+    if changed or expired:
+        save_maps([(reissues, './data/maps/reissues.json')])
+    return changed
+
+def map_assets(timeout=None):
+    global previous_by_name
+    # Only the first sync of the daemon reads the previous map from disk
+    if previous_by_name is None:
+        previous_by_name = load_map("by_name")
+    assets = send_command('listassets', ["", True], timeout=timeout)
 
     by_name = {}
     by_height = {}  # {<height>: {<name>: <data>}}
@@ -85,6 +131,10 @@ def map_assets():
     
     save_maps(maps_to_save)
 
+    # Saved after the maps, so the API never sees a reissue before the new hash
+    detect_reissues(previous_by_name, sorted_by_name)
+    previous_by_name = sorted_by_name
+
     return (
         sorted_by_name,
         sorted_by_height,
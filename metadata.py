@@ -0,0 +1,205 @@
+# Manticore Technologies LLC
+# (c) 2024
+# Manticore IPFS Mirror
+#       metadata.py
+
+import os
+import json
+import threading
+
+# Where parsed metadata documents and their index live
+METADATA_DIRECTORY = './data/metadata'
+METADATA_INDEX_PATH = './data/maps/by_metadata.json'
+
+# Metadata documents are small, anything bigger than this is treated as a regular file
+MAX_METADATA_SIZE = 1024 * 1024
+
+# Content types an IPFS gateway may use when serving a JSON document
+METADATA_CONTENT_TYPES = ('application/json', 'text/plain', 'application/octet-stream')
+
+# Fields that commonly reference the asset image, in order of preference
+IMAGE_FIELDS = ('image', 'image_url', 'imageUrl', 'image_ipfs', 'ipfs_hash', 'ipfs', 'logo', 'icon')
+
+# In memory copy of the index ({<metadata cid>: <image cid>}), shared by the download workers
+_index = None
+_index_lock = threading.Lock()
+
+# Copy of the index as last written to disk by the daemon, with the file's mtime
+_disk_index = {}
+_disk_index_mtime = None
+
+def is_metadata_content_type(content_type):
+    """
+    Check if a response with the given Content-Type could be a metadata document.
+    """
+    if not content_type:
+        return True
+    return content_type.split(';')[0].strip().lower() in METADATA_CONTENT_TYPES
+
+def parse_metadata(data):
+    """
+    Parse raw document bytes into a metadata dictionary.
+
+    Returns:
+    dict: The parsed metadata, or None if the data is not a JSON object.
+    """
+    if len(data) > MAX_METADATA_SIZE or not data.lstrip()[:1] == b'{':
+        return None
+    try:
+        metadata = json.loads(data.decode('utf-8'))
+    except (UnicodeDecodeError, ValueError):
+        return None
+    return metadata if isinstance(metadata, dict) else None
+
+def cid_from_reference(reference):
+    """
+    Extract a CID from an image reference such as "ipfs://<cid>", "/ipfs/<cid>",
+    "https://<gateway>/ipfs/<cid>/image.png" or a bare CID.
+    """
+    if not isinstance(reference, str):
+        return None
+    reference = reference.strip()
+
+    if reference.startswith('ipfs://'):
+        reference = reference[len('ipfs://'):]
+        if reference.startswith('ipfs/'):
+            reference = reference[len('ipfs/'):]
+    elif '/ipfs/' in reference:
+        reference = reference.split('/ipfs/', 1)[1]
+
+    cid = reference.split('/')[0].split('?')[0].split('#')[0]
+
+    # CIDv0 (base58 "Qm...") or CIDv1 (base32 "b...")
+    if (cid.startswith('Qm') and len(cid) == 46) or (cid.startswith('b') and len(cid) >= 50):
+        return cid
+    return None
+
+def extract_image_cid(metadata):
+    """
+    Find the CID of the image referenced by a metadata document.
+    """
+    for field in IMAGE_FIELDS:
+        cid = cid_from_reference(metadata.get(field))
+        if cid:
+            return cid
+
+    # Some documents nest the fields under "properties"
+    properties = metadata.get('properties')
+    if isinstance(properties, dict):
+        for field in IMAGE_FIELDS:
+            value = properties.get(field)
+            # EIP-1155 style {"image": {"description": "ipfs://..."}}
+            if isinstance(value, dict):
+                value = value.get('description') or value.get('value')
+            cid = cid_from_reference(value)
+            if cid:
+                return cid
+    return None
+
+def metadata_path(ipfs_hash):
+    return os.path.join(METADATA_DIRECTORY, f"{ipfs_hash}.json")
+
+def has_metadata(ipfs_hash):
+    """
+    Check if a metadata document is cached for the given IPFS hash.
+    """
+    return os.path.exists(metadata_path(ipfs_hash))
+
+def load_metadata(ipfs_hash):
+    """
+    Load a cached metadata document.
+
+    Returns:
+    dict: The metadata, or None if it is not cached.
+    """
+    path = metadata_path(ipfs_hash)
+    if not os.path.exists(path):
+        return None
+    with open(path, 'r') as file:
+        return json.load(file)
+
+def _get_index():
+    global _index
+    if _index is None:
+        try:
+            with open(METADATA_INDEX_PATH, 'r') as file:
+                _index = json.load(file)
+        except (OSError, ValueError):
+            _index = {}
+
+        # Documents saved before the index was flushed (e.g. the daemon stopped mid-batch)
+        # are indexed again from data/metadata, so their image is still fetched and kept
+        if os.path.exists(METADATA_DIRECTORY):
+            for filename in os.listdir(METADATA_DIRECTORY):
+                ipfs_hash, file_extension = os.path.splitext(filename)
+                if file_extension != '.json' or ipfs_hash in _index:
+                    continue
+                path = os.path.join(METADATA_DIRECTORY, filename)
+                with open(path, 'rb') as file:
+                    document = parse_metadata(file.read())
+                if document is None:
+                    # Partially written, drop it so the CID is downloaded again
+                    os.remove(path)
+                    continue
+                _index[ipfs_hash] = extract_image_cid(document)
+    return _index
+
+def save_metadata(ipfs_hash, metadata, image_cid):
+    """
+    Cache a parsed metadata document and record the image it references in the index.
+    The index is only written to disk by save_metadata_index.
+    """
+    with open(metadata_path(ipfs_hash), 'w') as file:
+        json.dump(metadata, file, indent=4)
+
+    with _index_lock:
+        _get_index()[ipfs_hash] = image_cid
+
+def save_metadata_index():
+    """
+    Write the metadata index ({<metadata cid>: <image cid>}) to disk.
+    """
+    with _index_lock:
+        index = dict(sorted(_get_index().items()))
+
+        # Written to a temporary file and swapped in, so readers never see a partial index
+        temporary_path = f"{METADATA_INDEX_PATH}.tmp"
+        with open(temporary_path, 'w') as file:
+            json.dump(index, file, indent=4)
+        os.replace(temporary_path, METADATA_INDEX_PATH)
+
+def read_metadata_index():
+    """
+    Return the index as last saved to disk, for processes that don't download
+    (the API). The file is only parsed again when its mtime changes.
+    """
+    global _disk_index, _disk_index_mtime
+    try:
+        mtime = os.path.getmtime(METADATA_INDEX_PATH)
+    except OSError:
+        return {}
+    if mtime != _disk_index_mtime:
+        try:
+            with open(METADATA_INDEX_PATH, 'r') as file:
+                _disk_index = json.load(file)
+            _disk_index_mtime = mtime
+        except (OSError, ValueError):
+            pass
+    return _disk_index
+
+def referenced_image_cids():
+    """
+    Return the image CIDs referenced by all cached metadata documents.
+    """
+    with _index_lock:
+        return [image_cid for image_cid in _get_index().values() if image_cid]
+
+def remove_metadata(ipfs_hash):
+    """
+    Remove a cached metadata document and its index entry.
+    """
+    path = metadata_path(ipfs_hash)
+    if os.path.exists(path):
+        os.remove(path)
+    with _index_lock:
+        _get_index().pop(ipfs_hash, None)
@@ -0,0 +1,225 @@
+# Manticore Technologies LLC
+# (c) 2024
+# Manticore IPFS Mirror
+#       resolver.py
+
+import os
+import json
+import threading
+import time
+from collections import OrderedDict, namedtuple
+from mimetypes import guess_type
+from utils import create_logger, config, load_map, is_placeholder
+import metadata
+
+# Initialize the logger
+logger = create_logger('resolver')
+
+IMAGES_DIRECTORY = './data/images'
+BY_NAME_PATH = './data/maps/by_name.json'
+REISSUES_PATH = './data/maps/reissues.json'
+FAILED_DOWNLOADS_PATH = './data/maps/failed_downloads.json'
+
+# Why a name could not be resolved to a cached file
+UNKNOWN_ASSET = 'unknown_asset'
+NO_IPFS = 'no_ipfs'
+PENDING_DOWNLOAD = 'pending_download'
+
+Resolution = namedtuple('Resolution', ['cid', 'path', 'mimetype'])
+
+def find_cached_file(cid):
+    """
+    Find the cached file for a CID regardless of its extension.
+
+    Returns:
+    str: The file path, or None if the CID is not cached.
+    """
+    for filename in os.listdir(IMAGES_DIRECTORY):
+        if os.path.splitext(filename)[0] == cid:
+            return os.path.join(IMAGES_DIRECTORY, filename)
+    return None
+
+def read_json(path, default):
+    """
+    Read a JSON file the daemon may be rewriting, returning None if it cannot be parsed right now.
+    """
+    if not os.path.exists(path):
+        return default
+    try:
+        with open(path, 'r') as file:
+            return json.load(file)
+    except (OSError, ValueError):
+        return None
+
+class NameResolver:
+    """
+    Resolves asset names to their cached file, keeping a bounded LRU of
+    name -> Resolution and a bounded, short lived cache of names that could not be resolved.
+
+    A background thread watches the asset map and reissues.json written by the
+    daemon: a changed asset map is reloaded off the request path, and a reissue
+    that changed an asset's ipfs_hash invalidates exactly that name.
+    """
+    def __init__(self, capacity=10000, negative_ttl=30, poll_interval=5):
+        self.capacity = capacity
+        self.negative_ttl = negative_ttl
+        self.poll_interval = poll_interval
+
+        self.entries = OrderedDict()  # {<name>: Resolution}
+        self.negative = OrderedDict()  # {<name>: (<reason>, <expires>)}
+        self.lock = threading.Lock()
+
+        # Bumped on every invalidation, so a lookup racing with it is not cached
+        self.generation = 0
+
+        self.by_name = {}
+        self.by_name_mtime = None
+        self.reissues_mtime = None
+        self.reissues_seen = time.time()
+        self.poller = None
+
+    def _mtime(self, path):
+        try:
+            return os.path.getmtime(path)
+        except OSError:
+            return None
+
+    def _start(self):
+        # Started lazily so each gunicorn worker gets its own poller after forking
+        with self.lock:
+            if self.poller is not None:
+                return
+            self.poller = threading.Thread(target=self._poll, name="name-resolver", daemon=True)
+            self.poller.start()
+        self._refresh()
+
+    def _poll(self):
+        while True:
+            time.sleep(self.poll_interval)
+            self._refresh()
+
+    def _refresh(self):
+        try:
+            self.refresh()
+        except Exception:
+            logger.exception("Failed to refresh the name resolution cache")
+
+    def refresh(self):
+        """
+        Reload the asset map if the daemon rewrote it and invalidate reissued names.
+        """
+        mtime = self._mtime(BY_NAME_PATH)
+        if mtime is not None and mtime != self.by_name_mtime:
+            by_name = load_map("by_name")
+            with self.lock:
+                self.by_name = by_name
+                self.by_name_mtime = mtime
+                # New assets may have appeared, forget what was unknown
+                self.negative.clear()
+                self.generation += 1
+            logger.info(f"Loaded {len(by_name)} assets for name resolution")
+
+        mtime = self._mtime(REISSUES_PATH)
+        if mtime is not None and mtime != self.reissues_mtime:
+            with open(REISSUES_PATH, 'r') as file:
+                reissues = json.load(file)
+            self.invalidate(
+                name for name, reissue in reissues.items()
+                if reissue.get('detected', 0) > self.reissues_seen
+            )
+            self.reissues_seen = max([self.reissues_seen] + [reissue.get('detected', 0) for reissue in reissues.values()])
+            self.reissues_mtime = mtime
+
+    def invalidate(self, names):
+        """
+        Drop the cached resolution of the given names.
+        """
+        with self.lock:
+            self.generation += 1
+            for name in names:
+                if self.entries.pop(name, None) is not None:
+                    logger.info(f"Invalidated name resolution for {name}", extra={'event': 'invalidate', 'asset': name})
+                self.negative.pop(name, None)
+
+    def asset(self, name):
+        """
+        Return the asset data for a name from the in-memory asset map, or None.
+        """
+        if self.poller is None:
+            self._start()
+        with self.lock:
+            return self.by_name.get(name.upper())
+
+    def resolve(self, name):
+        """
+        Resolve an asset name to its cached file.
+
+        Returns:
+        tuple: (Resolution, None) if the file is cached, otherwise (None, <reason>)
+        where reason is UNKNOWN_ASSET, NO_IPFS or PENDING_DOWNLOAD.
+        """
+        if self.poller is None:
+            self._start()
+        name = name.upper()
+
+        # Hot names are answered from memory
+        with self.lock:
+            resolution = self.entries.get(name)
+            if resolution is not None:
+                self.entries.move_to_end(name)
+                return resolution, None
+            negative = self.negative.get(name)
+            if negative is not None:
+                reason, expires = negative
+                if expires > time.time():
+                    return None, reason
+                del self.negative[name]
+            asset_data = self.by_name.get(name)
+            generation = self.generation
+
+        resolution, reason = self._lookup(asset_data)
+
+        with self.lock:
+            if generation == self.generation:
+                if resolution is not None:
+                    self.entries[name] = resolution
+                    self.entries.move_to_end(name)
+                    while len(self.entries) > self.capacity:
+                        self.entries.popitem(last=False)
+                else:
+                    self.negative[name] = (reason, time.time() + self.negative_ttl)
+                    self.negative.move_to_end(name)
+                    while len(self.negative) > self.capacity:
+                        self.negative.popitem(last=False)
+        return resolution, reason
+
+    def _lookup(self, asset_data):
+        if asset_data is None:
+            return None, UNKNOWN_ASSET
+        cid = asset_data.get('ipfs_hash')
+        if not asset_data.get('has_ipfs') or not cid:
+            return None, NO_IPFS
+
+        # Metadata documents are resolved to the image they reference
+        if metadata.has_metadata(cid):
+            cid = metadata.read_metadata_index().get(cid) or cid
+
+        # Failed downloads wait in the retry queue
+        failed_downloads = read_json(FAILED_DOWNLOADS_PATH, [])
+        if failed_downloads is None or cid in failed_downloads:
+            return None, PENDING_DOWNLOAD
+
+        # A placeholder is never cached as a resolution, it is replaced once the retry succeeds
+        path = find_cached_file(cid)
+        if path is None or is_placeholder(path):
+            return None, PENDING_DOWNLOAD
+
+        mimetype = guess_type(path)[0] or 'application/octet-stream'
+        return Resolution(cid, path, mimetype), None
+
+# Shared by every request of this process
+name_resolver = NameResolver(
+    capacity=config.getint('Resolver', 'capacity', fallback=10000),
+    negative_ttl=config.getint('Resolver', 'negative_ttl', fallback=30),
+    poll_interval=config.getint('Resolver', 'poll_interval', fallback=5),
+)
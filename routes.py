@@ -5,9 +5,31 @@
 
 from startup import app
 from rpc import send_command
-from utils import create_logger, config, load_map
-from flask import send_file, abort
+from utils import create_logger, config, sampled
+from flask import send_file, abort, jsonify, request, g
+from resolver import name_resolver, PENDING_DOWNLOAD
+import metadata
 import os
+import time
+
+# Initialize the logger
+logger = create_logger('routes')
+
+@app.before_request
+def start_timer():
+    g.request_started = time.perf_counter()
+
+@app.after_request
+def log_request(response):
+    # One sampled record per request, so busy mirrors don't flood the log
+    logger.info("Served request", extra=sampled(
+        event='request',
+        method=request.method,
+        path=request.path,
+        status=response.status_code,
+        duration_ms=round((time.perf_counter() - g.request_started) * 1000, 2),
+    ))
+    return response
 
 @app.route('/ipfs/cid/<cid>', methods=['GET'])
 def get_ipfs_content_bycid(cid):
@@ -29,13 +51,44 @@ def get_ipfs_content_bycid(cid):
             # Otherwise, send the file directly
             return send_file(file_path)
     
+    # If the CID is a metadata document, serve the image it references instead
+    image_cid = metadata.read_metadata_index().get(cid_base) if metadata.has_metadata(cid_base) else None
+    if image_cid and image_cid != cid_base:
+        return get_ipfs_content_bycid(image_cid)
+
     # If the file is not found, return a 404 error
     abort(404, description=f"File for CID {cid_base} not found")
 
 @app.route('/ipfs/name/<name>')
 def get_ipfs_content_byname(name):
-    by_name = load_map("by_name")
-    try:
-        return get_ipfs_content_bycid(by_name[name.upper()]['ipfs_hash'])
-    except:
-        return send_file("placeholder.png")
\ No newline at end of file
+    resolution, reason = name_resolver.resolve(name)
+
+    if resolution is not None:
+        try:
+            # If the file is a WebP image, serve it with a .png extension like the CID route
+            if resolution.mimetype == 'image/webp':
+                return send_file(resolution.path, mimetype=resolution.mimetype, download_name=f'{resolution.cid}.png')
+            return send_file(resolution.path, mimetype=resolution.mimetype)
+        except FileNotFoundError:
+            # The file was removed since it was cached (e.g. evicted), resolve again next time
+            name_resolver.invalidate([name.upper()])
+            reason = PENDING_DOWNLOAD
+
+    # Tell the client why it got the placeholder
+    response = send_file("placeholder.png")
+    response.headers['X-Placeholder-Reason'] = reason
+    return response
+
+@app.route('/ipfs/metadata/cid/<cid>', methods=['GET'])
+def get_ipfs_metadata_bycid(cid):
+    document = metadata.load_metadata(os.path.splitext(cid)[0])
+    if document is None:
+        abort(404, description=f"Metadata for CID {cid} not found")
+    return jsonify(document)
+
+@app.route('/ipfs/metadata/name/<name>', methods=['GET'])
+def get_ipfs_metadata_byname(name):
+    asset_data = name_resolver.asset(name)
+    if not asset_data or not asset_data.get('ipfs_hash'):
+        abort(404, description=f"Asset {name} has no IPFS metadata")
+    return get_ipfs_metadata_bycid(asset_data['ipfs_hash'])
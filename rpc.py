@@ -3,12 +3,13 @@
 # Manticore Crypto Faucet
 #       rpc.py 
 
+import logging
 import requests
 from utils import create_logger, config
 
 
 # Initialize the logger
-logger = create_logger()
+logger = create_logger('rpc')
 
 # Configuration settings for connecting to the Evrmore node
 host = config["Node"]["host"]
@@ -19,13 +20,14 @@ class AuthenticationError(Exception):
     """Custom exception for handling authentication errors."""
     pass
 
-def send_command(command, params=[]):
+def send_command(command, params=[], timeout=None):
     """
     Sends a JSON-RPC command to the Evrmore node and handles the response.
 
     Args:
         command (str): The command to be executed on the Evrmore node.
         params (list): A list of parameters for the command.
+        timeout (float): Seconds to wait for the node before giving up, or None to wait indefinitely.
 
     Returns:
         dict: The result of the command if successful.
@@ -42,7 +44,7 @@ def send_command(command, params=[]):
         headers = {"Content-Type": "application/json"}
         
         # Send the request to the Evrmore node
-        response = requests.post(url, json=payload, headers=headers, auth=auth)
+        response = requests.post(url, json=payload, headers=headers, auth=auth, timeout=timeout)
         
         # Check for authentication failure (HTTP status code 401)
         if response.status_code == 401:
@@ -60,7 +62,7 @@ def send_command(command, params=[]):
         else:
             # Log the length of the result and return it
             result = response_json.get('result')
-            if result is not None:
+            if result is not None and logger.isEnabledFor(logging.DEBUG):
                 logger.debug(f"Node replied with result of length {len(str(result))}")
             return result
     
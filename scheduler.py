@@ -0,0 +1,239 @@
+# Manticore Technologies LLC
+# (c) 2024
+# Manticore IPFS Mirror
+#       scheduler.py
+
+import json
+import threading
+import time
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from utils import create_logger
+
+# Initialize the logger
+logger = create_logger('scheduler')
+
+class JobContext:
+    """
+    Handed to every job run so long running work can stop early when the
+    scheduler is shutting down or the run has gone past its timeout.
+    """
+    def __init__(self, scheduler, job):
+        self.scheduler = scheduler
+        self.concurrency = job.concurrency
+        self.deadline = time.time() + job.timeout if job.timeout else None
+
+    def remaining(self):
+        """
+        Seconds left before the run times out (at least 1), or None without a timeout.
+        Pass it to blocking calls that cannot check should_stop themselves.
+        """
+        if self.deadline is None:
+            return None
+        return max(1, self.deadline - time.time())
+
+    def timed_out(self):
+        return self.deadline is not None and time.time() > self.deadline
+
+    def should_stop(self):
+        return self.scheduler.stopping() or self.timed_out()
+
+class Job:
+    """
+    A unit of work run by the scheduler, either every `interval` seconds or when
+    triggered. Only one run of a job is in flight at a time.
+
+    Parameters:
+    name (str): Unique name of the job, used for triggering and status.
+    func (callable): Called with a JobContext.
+    interval (int): Seconds between runs, or None for triggered only jobs.
+    concurrency (int): Number of workers the job may use for its own work.
+    timeout (int): Seconds after which the run is asked to stop, or None.
+    """
+    def __init__(self, name, func, interval=None, concurrency=1, timeout=None):
+        self.name = name
+        self.func = func
+        self.interval = interval
+        self.concurrency = concurrency
+        self.timeout = timeout
+
+        self.thread = None
+        self.triggered = False
+        self.next_run = time.time() if interval else None
+
+        self.state = 'idle'
+        self.runs = 0
+        self.failures = 0
+        self.last_started = None
+        self.last_finished = None
+        self.last_duration = None
+        self.last_error = None
+
+    def running(self):
+        return self.thread is not None and self.thread.is_alive()
+
+    def overdue(self):
+        return self.running() and self.timeout is not None and time.time() - self.last_started > self.timeout
+
+    def status(self):
+        return {
+            'name': self.name,
+            # A run past its timeout is still working on something it cannot interrupt
+            'state': 'overdue' if self.overdue() else self.state,
+            'interval': self.interval,
+            'concurrency': self.concurrency,
+            'timeout': self.timeout,
+            'runs': self.runs,
+            'failures': self.failures,
+            'last_started': self.last_started,
+            'last_finished': self.last_finished,
+            'last_duration': self.last_duration,
+            'running_for': round(time.time() - self.last_started, 3) if self.running() else None,
+            'last_error': self.last_error,
+            'next_run': self.next_run,
+            'triggered': self.triggered,
+        }
+
+class Scheduler:
+    """
+    Runs jobs on their own threads so a slow job never delays the others.
+    """
+    def __init__(self, tick=1):
+        self.tick = tick
+        self.jobs = {}
+        self.lock = threading.Lock()
+        self.stop_event = threading.Event()
+        self.thread = None
+
+    def add_job(self, name, func, interval=None, concurrency=1, timeout=None):
+        self.jobs[name] = Job(name, func, interval, concurrency, timeout)
+        return self.jobs[name]
+
+    def trigger(self, name):
+        """
+        Ask for a job to run as soon as possible. A trigger received while the
+        job is running starts another run once the current one has finished.
+        """
+        with self.lock:
+            if name not in self.jobs:
+                raise KeyError(f"Unknown job: {name}")
+            self.jobs[name].triggered = True
+
+    def stopping(self):
+        return self.stop_event.is_set()
+
+    def status(self):
+        with self.lock:
+            return [job.status() for job in self.jobs.values()]
+
+    def _run(self, job):
+        context = JobContext(self, job)
+        logger.info(f"Job {job.name} started")
+        try:
+            job.func(context)
+            error = None
+        except Exception as e:
+            error = f"{type(e).__name__}: {e}"
+            logger.exception(f"Job {job.name} failed: {error}")
+
+        with self.lock:
+            job.last_finished = time.time()
+            job.last_duration = round(job.last_finished - job.last_started, 3)
+            job.last_error = error
+            if error:
+                job.failures += 1
+                job.state = 'failed'
+            elif context.timed_out():
+                job.state = 'timed_out'
+            else:
+                job.state = 'succeeded'
+            if job.interval:
+                job.next_run = job.last_finished + job.interval
+
+        logger.info(f"Job {job.name} {job.state} in {job.last_duration}s", extra={'event': 'job', 'job': job.name, 'state': job.state, 'duration_ms': round(job.last_duration * 1000)})
+
+    def _loop(self):
+        while not self.stop_event.is_set():
+            now = time.time()
+            with self.lock:
+                for job in self.jobs.values():
+                    if job.running():
+                        continue
+                    due = job.next_run is not None and job.next_run <= now
+                    if not (due or job.triggered):
+                        continue
+
+                    job.triggered = False
+                    job.runs += 1
+                    job.state = 'running'
+                    job.last_started = now
+                    job.thread = threading.Thread(target=self._run, args=(job,), name=f"job-{job.name}", daemon=True)
+                    job.thread.start()
+            self.stop_event.wait(self.tick)
+
+    def start(self):
+        self.thread = threading.Thread(target=self._loop, name="scheduler", daemon=True)
+        self.thread.start()
+
+    def shutdown(self, grace_period=60):
+        """
+        Stop starting new runs and wait up to grace_period seconds for the
+        running jobs (and their in-flight downloads) to finish.
+        """
+        logger.info("Scheduler shutting down, waiting for running jobs")
+        self.stop_event.set()
+        if self.thread is not None:
+            self.thread.join()
+
+        deadline = time.time() + grace_period
+        for job in self.jobs.values():
+            if job.running():
+                job.thread.join(max(0, deadline - time.time()))
+                if job.running():
+                    logger.warning(f"Job {job.name} still running after {grace_period}s grace period")
+        logger.info("Scheduler stopped")
+
+def serve_admin(scheduler, host, port):
+    """
+    Start an HTTP server exposing the scheduler:
+
+    GET  /admin/jobs                  Status and durations of every job
+    POST /admin/jobs/<name>/trigger   Run a job as soon as possible
+
+    Returns:
+    ThreadingHTTPServer: The running server, call shutdown() to stop it.
+    """
+    class AdminHandler(BaseHTTPRequestHandler):
+        def _reply(self, status, body):
+            data = json.dumps(body, indent=4).encode()
+            self.send_response(status)
+            self.send_header('Content-Type', 'application/json')
+            self.send_header('Content-Length', str(len(data)))
+            self.end_headers()
+            self.wfile.write(data)
+
+        def do_GET(self):
+            if self.path.rstrip('/') == '/admin/jobs':
+                self._reply(200, {'stopping': scheduler.stopping(), 'jobs': scheduler.status()})
+            else:
+                self._reply(404, {'error': 'Not found'})
+
+        def do_POST(self):
+            parts = self.path.strip('/').split('/')
+            if len(parts) == 4 and parts[:2] == ['admin', 'jobs'] and parts[3] == 'trigger':
+                try:
+                    scheduler.trigger(parts[2])
+                except KeyError as e:
+                    self._reply(404, {'error': str(e)})
+                    return
+                self._reply(202, {'triggered': parts[2]})
+            else:
+                self._reply(404, {'error': 'Not found'})
+
+        def log_message(self, format, *args):
+            logger.debug(f"Admin request: {format % args}")
+
+    server = ThreadingHTTPServer((host, port), AdminHandler)
+    server.daemon_threads = True
+    threading.Thread(target=server.serve_forever, name="admin-http", daemon=True).start()
+    logger.info(f"Admin endpoint listening on http://{host}:{port}/admin/jobs")
+    return server
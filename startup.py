@@ -1,11 +1,14 @@
 # Import utilities
-from utils import create_logger, welcome_message, config, initialize_directories, save_maps, load_map, download_image
+from utils import create_logger, welcome_message, config, initialize_directories, save_maps, load_map, download_images, download_workers, failed_downloads_lock, failed_downloads_path
+import metadata
 import os
 import time
 import json
+import signal
+import threading
 
 # Create a logger
-logger = create_logger()
+logger = create_logger('startup')
 
 # Import flask
 from flask import Flask
@@ -15,8 +18,9 @@ app = Flask("Manticore IPFS Mirror")
 from flask_cors import CORS
 CORS(app, resources={r"/*": {"origins": "*"}})  # Allow all origins for testing purposes
 
-# Log the welcome message
-logger.info(welcome_message)
+# Show the welcome message on the console, the log file only gets a single structured record
+print(welcome_message)
+logger.info("Manticore IPFS Mirror starting", extra={'event': 'startup', 'pid': os.getpid()})
 
 def cleanup_duplicates(directory):
     """
@@ -82,7 +86,47 @@ def file_exists_base(directory, base_name):
             return True
     return False
 
-def retry_failed_downloads():
+def cached_hashes(directory):
+    """
+    Return the set of IPFS hashes that are already cached, either as a file in
+    the directory (regardless of extension) or as a metadata document.
+    """
+    cached = {os.path.splitext(filename)[0] for filename in os.listdir(directory)}
+    cached.update(os.path.splitext(filename)[0] for filename in os.listdir(metadata.METADATA_DIRECTORY))
+    return cached
+
+def migrate_metadata_files(directory):
+    """
+    Move JSON metadata documents that earlier versions stored as images into the
+    metadata cache, and download the images they reference.
+    """
+    logger.info("Migrating metadata documents out of the images directory")
+    image_hashes = []
+
+    for filename in os.listdir(directory):
+        ipfs_hash, file_extension = os.path.splitext(filename)
+        if file_extension.lower() != '.json':
+            continue
+
+        file_path = os.path.join(directory, filename)
+        with open(file_path, 'rb') as file:
+            document = metadata.parse_metadata(file.read())
+        if document is None:
+            continue
+
+        image_cid = metadata.extract_image_cid(document)
+        metadata.save_metadata(ipfs_hash, document, image_cid)
+        os.remove(file_path)
+        if image_cid:
+            image_hashes.append(image_cid)
+
+    cached = cached_hashes(directory)
+    download_images(image_hash for image_hash in image_hashes if image_hash not in cached)
+    metadata.save_metadata_index()
+
+    logger.info(f"Metadata migration complete, {len(image_hashes)} referenced images checked")
+
+def retry_failed_downloads(max_workers=None, should_stop=None):
     """
     Retry downloading images for IPFS hashes listed in failed_downloads.json.
     """
@@ -96,27 +140,128 @@ def retry_failed_downloads():
         
         logger.info(f"Retrying {len(failed_downloads)} failed downloads...")
         
-        successful_retries = []
-        for ipfs_hash in failed_downloads:
-            logger.info(f"Retrying download for IPFS hash: {ipfs_hash}")
-            download_image(ipfs_hash)
-            # Check if download was successful
-            if file_exists_base("./data/images", ipfs_hash):
-                successful_retries.append(ipfs_hash)
-        
-        # Remove successfully retried IPFS hashes from failed_downloads.json
-        remaining_failed_downloads = [hash for hash in failed_downloads if hash not in successful_retries]
-        with open(failed_downloads_path, 'w') as f:
-            json.dump(remaining_failed_downloads, f)
+        # download_image removes each successful retry from failed_downloads.json itself
+        download_images(failed_downloads, max_workers, should_stop)
+
+        with failed_downloads_lock:
+            with open(failed_downloads_path, 'r') as f:
+                remaining_failed_downloads = json.load(f)
         
         logger.info(f"Retry complete. {len(remaining_failed_downloads)} downloads still failed.")
     else:
         logger.info("No failed downloads to retry.")
 
+def download_missing_images(max_workers=None, should_stop=None):
+    """
+    Download every asset image (and image referenced by a metadata document) that is not cached yet.
+    """
+    by_ipfshash = load_map("by_ipfshash")
+
+    # Check if we have all the files saved
+    cached = cached_hashes("./data/images")
+    missing = [ipfs_hash for ipfs_hash in by_ipfshash if ipfs_hash not in cached]
+    missing += [image_cid for image_cid in set(metadata.referenced_image_cids()) if image_cid not in cached]
+    logger.info(f"{len(missing)} images not cached, downloading")
+
+    # If we are missing any then try saving them (metadata documents are followed to their image)
+    download_images(missing, max_workers, should_stop)
+
+def evict_cache(directory, should_stop=None):
+    """
+    Remove cached images and metadata documents that no asset references anymore
+    (e.g. after a reissue changed the asset's IPFS hash).
+    """
+    by_ipfshash = load_map("by_ipfshash")
+
+    # Never evict against an empty map, the asset sync has not completed yet
+    if not by_ipfshash:
+        logger.info("Asset map is empty, skipping cache eviction")
+        return
+
+    evicted = 0
+    for filename in os.listdir(metadata.METADATA_DIRECTORY):
+        ipfs_hash = os.path.splitext(filename)[0]
+        if ipfs_hash not in by_ipfshash:
+            metadata.remove_metadata(ipfs_hash)
+            evicted += 1
+    metadata.save_metadata_index()
+
+    referenced = set(by_ipfshash)
+    referenced.update(metadata.referenced_image_cids())
+    for filename in os.listdir(directory):
+        if should_stop is not None and should_stop():
+            break
+        if os.path.splitext(filename)[0] not in referenced:
+            os.remove(os.path.join(directory, filename))
+            evicted += 1
+
+    # Evicted CIDs must not be retried (and get a new placeholder) by the retry queue
+    with failed_downloads_lock:
+        if os.path.exists(failed_downloads_path):
+            with open(failed_downloads_path, 'r') as f:
+                failed_downloads = json.load(f)
+            with open(failed_downloads_path, 'w') as f:
+                json.dump([ipfs_hash for ipfs_hash in failed_downloads if ipfs_hash in referenced], f, indent=4)
+
+    logger.info(f"Cache eviction complete, {evicted} files removed")
+
+def job_setting(job_name, setting, default):
+    """
+    Read a job setting (e.g. "asset_sync_interval") from the Scheduler section of the configuration.
+    """
+    return config.getint('Scheduler', f'{job_name}_{setting}', fallback=default)
+
+def build_scheduler():
+    """
+    Register the daemon's jobs. Each job gets its own interval, concurrency and
+    timeout, overridable in the Scheduler section of the configuration.
+    """
+    from downloader import map_assets
+    from scheduler import Scheduler
+
+    scheduler = Scheduler()
+
+    def asset_sync(context):
+        logger.info("Updating asset maps")
+        map_assets(timeout=context.remaining())
+        # New assets may need images, fill them right away
+        scheduler.trigger('missing_images')
+
+    def missing_images(context):
+        download_missing_images(context.concurrency, context.should_stop)
+
+    def retry_queue(context):
+        retry_failed_downloads(context.concurrency, context.should_stop)
+
+    def duplicate_cleanup(context):
+        cleanup_duplicates("./data/images")
+        map_filetypes("./data/images")
+
+    def cache_eviction(context):
+        evict_cache("./data/images", context.should_stop)
+
+    jobs = [
+        # (name, function, interval, concurrency, timeout)
+        ('asset_sync', asset_sync, 60, 1, 600),
+        ('missing_images', missing_images, 300, download_workers, 3600),
+        ('retry_queue', retry_queue, 600, max(1, download_workers // 2), 1800),
+        ('duplicate_cleanup', duplicate_cleanup, 3600, 1, 600),
+        ('cache_eviction', cache_eviction, 86400, 1, 600),
+    ]
+    for name, func, interval, concurrency, timeout in jobs:
+        scheduler.add_job(
+            name,
+            func,
+            interval=job_setting(name, 'interval', interval) or None,
+            concurrency=job_setting(name, 'concurrency', concurrency),
+            timeout=job_setting(name, 'timeout', timeout) or None,
+        )
+    return scheduler
+
 if __name__=="__main__":
     logger.info("Starting image downloader")
     
-    from downloader import map_assets
+    from scheduler import serve_admin
 
     # Initialize the necessary directories
     logger.info("Initializing necessary directories")
@@ -126,42 +271,34 @@ if __name__=="__main__":
     logger.info("Cleaning up duplicate files in the images directory")
     cleanup_duplicates("./data/images")
 
-    # Map and save the file extensions to IPFS hashes in the images directory
-    logger.info("Mapping file extensions to IPFS hashes")
-    filetype_map = map_filetypes("./data/images")
+    # Move metadata documents saved as images by earlier versions
+    migrate_metadata_files("./data/images")
 
-    # Load the network assets by height
-    logger.info("Loading network assets")
-    by_name = load_map("by_name")
-    by_ipfshash = load_map("by_ipfshash")
-    
-    # Initialize the maps if nothing was loaded
-    if len(by_name) == 0 or len(by_ipfshash) == 0:
-        logger.info("No data loaded, initializing maps")
-        maps = map_assets()
-        by_name = maps[0]
-        by_ipfshash = maps[3]
-    
-    while True:
-        logger.info("Updating asset maps")
-        
-        # Reload the asset maps with the latest data
-        by_ipfshash = map_assets()[3]
-        
-        # Check if we have all the files saved
-        for ipfs_hash in by_ipfshash:
-            if not file_exists_base("./data/images", ipfs_hash):
-                logger.info(f"Image not cached, downloading: {ipfs_hash}")
-                # If we are missing one then try saving it
-                download_image(ipfs_hash)
-        
-        # Retry failed downloads
-        logger.info("Retrying failed downloads")
-        retry_failed_downloads()
-        
-        # Sleep for a minute
-        logger.info("Sleeping for 60 seconds")
-        time.sleep(60)
+    # Start the jobs, every interval job runs once right away
+    scheduler = build_scheduler()
+    scheduler.start()
+
+    # Expose job status over HTTP
+    admin_server = serve_admin(
+        scheduler,
+        config.get('Scheduler', 'admin_host', fallback='127.0.0.1'),
+        config.getint('Scheduler', 'admin_port', fallback=8003),
+    )
+
+    # Stop gracefully on SIGTERM (systemd) or SIGINT (ctrl+c)
+    shutdown_requested = threading.Event()
+    def request_shutdown(signum, frame):
+        logger.info(f"Received signal {signum}, shutting down")
+        shutdown_requested.set()
+    signal.signal(signal.SIGTERM, request_shutdown)
+    signal.signal(signal.SIGINT, request_shutdown)
+
+    while not shutdown_requested.is_set():
+        shutdown_requested.wait(1)
+
+    # Let in-flight downloads finish before exiting
+    scheduler.shutdown(config.getint('Scheduler', 'shutdown_grace', fallback=60))
+    admin_server.shutdown()
 
 else:
     logger.info("Let's start the flask app here since it's gunicorn")
@@ -4,12 +4,89 @@
 #       utils.py 
 
 import logging
+import logging.handlers
+import atexit
+import copy
+import queue
+import sys
+import random
 import colorlog
+import json
 import os
 
-def create_logger():
-    logger = logging.getLogger(os.path.basename(__file__))
-    
+# Attributes every LogRecord has, anything else was passed through `extra`
+STANDARD_RECORD_ATTRIBUTES = set(vars(logging.LogRecord('', 0, '', 0, '', None, None))) | {'message', 'asctime', 'sampled'}
+
+# The listener writing queued records to the console and log file, started once per process
+log_listener = None
+
+class JsonFormatter(logging.Formatter):
+    """
+    Formats a record as a single JSON line, including any fields passed through `extra`.
+    """
+    def format(self, record):
+        entry = {
+            'ts': self.formatTime(record, "%Y-%m-%dT%H:%M:%S"),
+            'level': record.levelname,
+            'logger': record.name,
+            'msg': record.getMessage(),
+        }
+        for key, value in vars(record).items():
+            if key not in STANDARD_RECORD_ATTRIBUTES:
+                entry[key] = value
+        if record.exc_text:
+            entry['exc'] = record.exc_text
+        return json.dumps(entry, default=str)
+
+class StructuredQueueHandler(logging.handlers.QueueHandler):
+    """
+    A QueueHandler that keeps the traceback in exc_text instead of folding it
+    into the message, so the JSON log gets it as a separate "exc" field.
+    """
+    def prepare(self, record):
+        record = copy.copy(record)
+        record.msg = record.getMessage()
+        record.args = None
+        if record.exc_info:
+            record.exc_text = logging.Formatter().formatException(record.exc_info)
+        record.exc_info = None
+        return record
+
+class SamplingFilter(logging.Filter):
+    """
+    Keeps only a fraction of the records logged with `extra=sampled(...)`.
+    Warnings and errors are always kept.
+    """
+    def __init__(self, rate):
+        super().__init__()
+        self.rate = rate
+
+    def filter(self, record):
+        if not getattr(record, 'sampled', False) or record.levelno >= logging.WARNING:
+            return True
+        if random.random() < self.rate:
+            record.sample_rate = self.rate
+            return True
+        return False
+
+def sampled(**fields):
+    """
+    Build the `extra` for a high volume (per-request or per-CID) event, e.g.
+    logger.info("Served file", extra=sampled(event='serve', cid=cid)).
+    """
+    fields['sampled'] = True
+    return fields
+
+def configure_logging():
+    """
+    Configure the "manticore" logger once per process. Records are handed to a
+    queue and written to the console and a size-rotated JSON log file by a
+    background listener, so logging never blocks on disk I/O.
+    """
+    global log_listener
+    if log_listener is not None:
+        return
+
     try:
         log_level = config['General']['log_level']
     except KeyError:
@@ -20,12 +97,15 @@ def create_logger():
     except KeyError:
         raise KeyError("The 'log_file' setting is missing in the 'Logging' section of the configuration.")
 
-    # Set the logging level
-    logger.setLevel(log_level)
+    # Each process (e.g. "startup" for the daemon, "gunicorn" for the API) rotates its
+    # own file, RotatingFileHandler is not safe with several processes on one file
+    log_root, log_extension = os.path.splitext(log_file)
+    process_name = os.path.splitext(os.path.basename(sys.argv[0]))[0] or 'python'
+    log_file = f"{log_root}.{process_name}{log_extension or '.log'}"
 
-    # Clear existing handlers if any
-    if logger.hasHandlers():
-        logger.handlers.clear()
+    max_bytes = config.getint('Logging', 'max_bytes', fallback=10 * 1024 * 1024)
+    backup_count = config.getint('Logging', 'backup_count', fallback=5)
+    sample_rate = config.getfloat('Logging', 'sample_rate', fallback=0.01)
 
     # Create a stream handler with color formatting
     ch = logging.StreamHandler()
@@ -47,14 +127,34 @@ def create_logger():
     )
     
     ch.setFormatter(formatter)
-    logger.addHandler(ch)
     
-    # Create a file handler
-    fh = logging.FileHandler(log_file)
+    # Create a size rotated file handler with structured records
+    fh = logging.handlers.RotatingFileHandler(log_file, maxBytes=max_bytes, backupCount=backup_count)
     fh.setLevel(log_level)
-    logger.addHandler(fh)
-    
-    return logger
+    fh.setFormatter(JsonFormatter())
+
+    # Loggers only enqueue, the listener thread does the writing
+    log_queue = queue.SimpleQueue()
+    qh = StructuredQueueHandler(log_queue)
+    qh.addFilter(SamplingFilter(sample_rate))
+
+    logger = logging.getLogger('manticore')
+    logger.setLevel(log_level)
+    logger.propagate = False
+    logger.handlers.clear()
+    logger.addHandler(qh)
+
+    log_listener = logging.handlers.QueueListener(log_queue, ch, fh, respect_handler_level=True)
+    log_listener.start()
+    atexit.register(log_listener.stop)
+
+def create_logger(name=None):
+    """
+    Return a child of the "manticore" logger, configuring logging on first use.
+    """
+    configure_logging()
+    return logging.getLogger(f'manticore.{name}' if name else 'manticore')
+
 # Arguments #
 import argparse
 
@@ -79,6 +179,9 @@ settings.read('settings.conf')
 config = configparser.ConfigParser()
 config.read(settings['General']['config_path'])
 
+# Initialize the logger
+logger = create_logger('utils')
+
 # Welcome #
 welcome_message =(
         "\n"
@@ -93,17 +196,16 @@ welcome_message =(
 )
 
 # Cache #
-import json
 def initialize_directories():
-    directories = ['./data/images', './data/maps']
+    directories = ['./data/images', './data/maps', './data/metadata']
 
     # Create directories if they don't exist
     for directory in directories:
         if not os.path.exists(directory):
             os.makedirs(directory)
-            print(f"Directory '{directory}' created.")
+            logger.info(f"Directory '{directory}' created.")
         else:
-            print(f"Directory '{directory}' already exists.")
+            logger.debug(f"Directory '{directory}' already exists.")
 
 
 
@@ -117,7 +219,7 @@ def save_maps(maps):
     for map_data, file_path in maps:
         with open(file_path, 'w') as file:
             json.dump(map_data, file, indent=4)
-            print(f"Saved map to {file_path}")
+            logger.debug("Saved map to %s", file_path)
 
 def load_maps(map_paths):
     """
@@ -134,9 +236,9 @@ def load_maps(map_paths):
         if os.path.exists(file_path):
             with open(file_path, 'r') as file:
                 loaded_maps[map_name] = json.load(file)
-                print(f"Loaded map '{map_name}' from {file_path}")
+                logger.debug("Loaded map '%s' from %s", map_name, file_path)
         else:
-            print(f"File '{file_path}' does not exist. Map '{map_name}' not loaded.")
+            logger.warning("File '%s' does not exist. Map '%s' not loaded.", file_path, map_name)
             loaded_maps[map_name] = {}
     return loaded_maps
 def load_map(map_name):
@@ -153,26 +255,72 @@ def load_map(map_name):
         with open(f"./data/maps/{map_name}.json", 'r') as file:
             return json.load(file)
     else:
-        print(f"File '{map_name}' does not exist. Map '{map_name}' not loaded.")
+        logger.warning("File '%s' does not exist. Map '%s' not loaded.", map_name, map_name)
         return {}
 
 import requests
 import time
+import threading
+from concurrent.futures import ThreadPoolExecutor, wait
 from mimetypes import guess_extension, add_type
+import metadata
 
 # Ensure .webp MIME type is recognized
 add_type('image/webp', '.webp')
-def download_image(ipfs_hash):
-    print("ipfs_hash:", ipfs_hash)
+
+# Number of CIDs downloaded in parallel, metadata hops run inside the same workers
+download_workers = config.getint('Downloader', 'max_workers', fallback=8)
+
+# Guards failed_downloads.json against concurrent read-modify-write from the workers
+failed_downloads_lock = threading.Lock()
+failed_downloads_path = './data/maps/failed_downloads.json'
+
+# Failed downloads are cached as a copy of this image until a retry succeeds
+placeholder_path = './placeholder.png'
+with open(placeholder_path, 'rb') as placeholder_file:
+    placeholder_data = placeholder_file.read()
+
+def is_placeholder(path):
+    """
+    Check if a cached file is a copy of the placeholder rather than a real image.
+    """
+    try:
+        if os.path.getsize(path) != len(placeholder_data):
+            return False
+        with open(path, 'rb') as file:
+            return file.read() == placeholder_data
+    except OSError:
+        return False
+
+def update_failed_downloads(ipfs_hash, failed):
+    """
+    Add (failed=True) or remove (failed=False) an IPFS hash from failed_downloads.json.
+    """
+    with failed_downloads_lock:
+        if os.path.exists(failed_downloads_path):
+            with open(failed_downloads_path, 'r') as file:
+                failed_downloads = json.load(file)
+        else:
+            failed_downloads = []
+
+        if failed and ipfs_hash not in failed_downloads:
+            failed_downloads.append(ipfs_hash)
+        elif not failed and ipfs_hash in failed_downloads:
+            failed_downloads.remove(ipfs_hash)
+        else:
+            return
+
+        with open(failed_downloads_path, 'w') as file:
+            json.dump(failed_downloads, file, indent=4)
+
+def download_image(ipfs_hash, follow_metadata=True):
+    """
+    Download the content for an IPFS hash into ./data/images.
+
+    If the content is a JSON metadata document it is cached in ./data/metadata instead,
+    and the image it references is downloaded as well (one hop only).
+    """
     image_url = f"http://localhost:8080/ipfs/{ipfs_hash}"
-    
-    # Load existing failed downloads
-    failed_downloads_path = './data/maps/failed_downloads.json'
-    if os.path.exists(failed_downloads_path):
-        with open(failed_downloads_path, 'r') as file:
-            failed_downloads = json.load(file)
-    else:
-        failed_downloads = []
 
     # Try downloading the image
     try:
@@ -181,6 +329,34 @@ def download_image(ipfs_hash):
         
         # Determine the file extension based on the Content-Type header
         content_type = response.headers.get('Content-Type')
+        chunks = response.iter_content(8192)
+
+        # Buffer anything that could be a JSON document so it can be inspected
+        buffered = bytearray()
+        if follow_metadata and metadata.is_metadata_content_type(content_type):
+            for chunk in chunks:
+                buffered += chunk
+                if len(buffered) > metadata.MAX_METADATA_SIZE:
+                    break
+
+            document = metadata.parse_metadata(buffered)
+            if document is not None:
+                image_cid = metadata.extract_image_cid(document)
+                metadata.save_metadata(ipfs_hash, document, image_cid)
+                logger.info("Cached metadata", extra=sampled(event='metadata', cid=ipfs_hash, image_cid=image_cid))
+                update_failed_downloads(ipfs_hash, failed=False)
+
+                # Drop any placeholder or raw JSON stored as the "image" by earlier runs
+                for extension in ('.png', '.json'):
+                    stale_path = f"./data/images/{ipfs_hash}{extension}"
+                    if os.path.exists(stale_path):
+                        os.remove(stale_path)
+
+                # Follow the referenced image, unless it points back at the document
+                if image_cid and image_cid != ipfs_hash:
+                    download_image(image_cid, follow_metadata=False)
+                return
+
         if content_type:
             extension = guess_extension(content_type.split(';')[0].strip())
             if not extension:
@@ -191,41 +367,70 @@ def download_image(ipfs_hash):
         # Construct the full image path with the correct extension
         image_path = os.path.join(f"./data/images/{ipfs_hash}{extension}")
 
-        # Return if already cached
-        if os.path.exists(image_path):
+        # Return if already cached, a placeholder from an earlier failure is replaced
+        if os.path.exists(image_path) and not is_placeholder(image_path):
+            update_failed_downloads(ipfs_hash, failed=False)
             return
 
         # Save the image to the specified path
         with open(image_path, 'wb') as f:
-            for chunk in response.iter_content(8192):
+            f.write(buffered)
+            for chunk in chunks:
                 f.write(chunk)
 
-        print(f"Downloaded image for IPFS hash {ipfs_hash} as {image_path}")
+        logger.info("Downloaded image", extra=sampled(event='download', cid=ipfs_hash, path=image_path))
         time.sleep(0.3)
 
+        # Drop the placeholder left by an earlier failure if the image has another extension
+        stale_path = f"./data/images/{ipfs_hash}.png"
+        if stale_path != image_path and is_placeholder(stale_path):
+            os.remove(stale_path)
+
         # If the download is successful, remove it from the failed downloads list if it exists there
-        if ipfs_hash in failed_downloads:
-            failed_downloads.remove(ipfs_hash)
+        update_failed_downloads(ipfs_hash, failed=False)
 
     except (requests.RequestException, requests.Timeout) as e:
-        print(f"Failed to download image for IPFS hash {ipfs_hash}. Saving placeholder.")
-        
-        # Save placeholder image data
-        placeholder_path = "./placeholder.png"
-        with open(placeholder_path, 'rb') as placeholder_file:
-            placeholder_data = placeholder_file.read()
+        logger.warning("Failed to download image, saving placeholder", extra={'event': 'download_failed', 'cid': ipfs_hash, 'error': str(e)})
         
         # Save the placeholder image with a .png extension
         image_path = os.path.join(f"./data/images/{ipfs_hash}.png")
-        with open(image_path, 'wb') as f:
-            f.write(placeholder_data)
+        if not os.path.exists(image_path):
+            with open(image_path, 'wb') as f:
+                f.write(placeholder_data)
 
         # Add the failed download to the list if it's not already there
-        if ipfs_hash not in failed_downloads:
-            failed_downloads.append(ipfs_hash)
-    
-    # Save the updated failed downloads list
-    with open(failed_downloads_path, 'w') as file:
-        json.dump(failed_downloads, file, indent=4)
+        update_failed_downloads(ipfs_hash, failed=True)
+
+    return
 
-    return
\ No newline at end of file
+def download_images(ipfs_hashes, max_workers=None, should_stop=None):
+    """
+    Download several IPFS hashes concurrently with at most max_workers in flight,
+    then persist the metadata index collected along the way.
+
+    If should_stop returns True, downloads that have not started yet are cancelled
+    while the ones in flight are allowed to finish.
+    """
+    ipfs_hashes = list(ipfs_hashes)
+    if not ipfs_hashes:
+        return
+    started = time.time()
+
+    with ThreadPoolExecutor(max_workers=max_workers or download_workers) as executor:
+        futures = [executor.submit(download_image, ipfs_hash) for ipfs_hash in ipfs_hashes]
+        for future in futures:
+            if should_stop is not None:
+                while not future.done() and not should_stop():
+                    wait([future], timeout=1)
+                if should_stop():
+                    # Cancel what has not started, the executor still waits for in-flight downloads
+                    for pending in futures:
+                        pending.cancel()
+                    break
+            try:
+                future.result()
+            except Exception as e:
+                logger.exception("Unexpected error while downloading")
+
+    metadata.save_metadata_index()
+    logger.info(f"Processed {len(ipfs_hashes)} IPFS hashes", extra={'event': 'download_batch', 'count': len(ipfs_hashes), 'duration_ms': round((time.time() - started) * 1000)})